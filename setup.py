@@ -1,7 +1,24 @@
+import re
+import sys
 from pathlib import Path
 
 import setuptools
 
+# _blochcore.pyx declares its nogil helpers noexcept, which older Cython releases cannot parse
+MIN_CYTHON_VERSION = (0, 29, 31)
+
+try:
+    import Cython
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+else:
+    cython_version = tuple(int(v) for v in re.findall(r'\d+', Cython.__version__)[:3])
+    if cython_version < MIN_CYTHON_VERSION:
+        print('Cython %s is older than %s; skipping the _blochcore extension'
+              % (Cython.__version__, '.'.join(map(str, MIN_CYTHON_VERSION))), file=sys.stderr)
+        cythonize = None
+
 here = Path(__file__).parent
 
 with open(str(here / 'README.md'), encoding='utf-8') as f:
@@ -11,6 +28,26 @@ with open(str(here / 'requirements.txt'), 'r') as f:
     install_reqs = f.read().strip()
     install_reqs = install_reqs.split("\n")
 
+# Optional compiled Bloch simulation core; without Cython or a compiler the simulation uses Numba or pure Python
+ext_modules = []
+if cythonize is not None:
+    if sys.platform == 'win32':
+        compile_args, link_args = ['/O2', '/openmp'], []
+    elif sys.platform == 'darwin':
+        # Apple clang ships without OpenMP; prange then runs serially
+        compile_args, link_args = ['-O3'], []
+    else:
+        compile_args, link_args = ['-O3', '-fopenmp'], ['-fopenmp']
+    try:
+        ext_modules = cythonize([setuptools.Extension('virtualscanner.server.simulation.bloch._blochcore',
+                                                      ['virtualscanner/server/simulation/bloch/_blochcore.pyx'],
+                                                      extra_compile_args=compile_args, extra_link_args=link_args,
+                                                      optional=True)])
+    except Exception as e:
+        # optional=True only covers the C compiler; a failed Cython translation must not stop the install either
+        print('Could not cythonize _blochcore (%s); skipping the extension' % e, file=sys.stderr)
+        ext_modules = []
+
 setuptools.setup(
     name='virtual-scanner',
     author='imr-framework',
@@ -19,8 +56,9 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url='https://github.com/imr-framework/virtual-scanner',
-    version=2.0.0,
+    version='2.0.0',
     packages=setuptools.find_packages(),
+    ext_modules=ext_modules,
     install_requires=install_reqs,
     license='License :: OSI Approved :: GNU Affero General Public License v3',
     include_package_data=True,
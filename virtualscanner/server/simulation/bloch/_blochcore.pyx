@@ -0,0 +1,329 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True, initializedcheck=False
+# Copyright of the Board of Trustees of Columbia University in the City of New York
+"""
+Ahead-of-time compiled kernels for applying packed pulseq commands
+
+C counterpart of pulseq_blochsim_kernels.run_pulseq_commands(), working on the arrays of a SeqInfo
+(see pulseq_seqinfo). run_pulseq_commands_batch() additionally runs many spin groups in parallel
+with OpenMP threads.
+
+The extension is built by setup.py when Cython is available; otherwise the simulation
+falls back to the Numba kernels or the SpinGroup methods.
+"""
+
+import numpy as np
+from virtualscanner.server.simulation.bloch.spingroup_ps import GAMMA as SG_GAMMA, GAMMA_BAR as SG_GAMMA_BAR
+from cython.parallel cimport prange, threadid
+from libc.math cimport exp, cos, sin, isnan
+from libc.stdint cimport int8_t, int64_t
+
+# Same constants as spingroup_ps and command codes as pulseq_blochsim_kernels
+cdef double PI = 3.141592653589793
+cdef double GAMMA_BAR = SG_GAMMA_BAR
+cdef double GAMMA = SG_GAMMA
+cdef int8_t CMD_DELAY = 0
+cdef int8_t CMD_RF = 1
+cdef int8_t CMD_READOUT = 2
+cdef int8_t CMD_GRAD = 3
+
+
+cdef inline void _precess(double* m, double phi, double t, double T1, double T2) noexcept nogil:
+    """Free precession by angle phi with relaxation over time t (SpinGroup.fpwg)"""
+    cdef double E1 = 1.0 if T1 == 0 else exp(-t/T1)
+    cdef double E2 = 1.0 if T2 == 0 else exp(-t/T2)
+    cdef double C = cos(phi)
+    cdef double S = sin(phi)
+    cdef double mx = m[0]
+    cdef double my = m[1]
+    m[0] = E2*(C*mx + S*my)
+    m[1] = E2*(-S*mx + C*my)
+    m[2] = E1*m[2] + 1 - E1
+
+
+cdef inline void _fpwg(double* m, double ax, double ay, double az, double t, double T1, double T2,
+                       const double* loc, double df) noexcept nogil:
+    """SpinGroup.fpwg() with gradient areas (ax, ay, az)"""
+    _precess(m, GAMMA*(loc[0]*ax + loc[1]*ay + loc[2]*az) + 2*PI*df*t, t, T1, T2)
+
+
+cdef void _apply_rf(double* m, const double complex* b1, double complex b1_scale, const double* grad, int64_t n,
+                    int64_t stride, double dt, double T1, double T2, const double* loc, double df) noexcept nogil:
+    """SpinGroup.apply_rf(); grad holds Gx, Gy, Gz of length n, stride elements apart"""
+    cdef double dB = df/GAMMA_BAR
+    cdef double T1_inv = 1/T1 if T1 > 0 else 0.0
+    cdef double T2_inv = 1/T2 if T2 > 0 else 0.0
+    cdef double complex b
+    cdef double B1x, B1y, w, mx, my, mz
+    cdef int64_t v
+    for v in range(n):
+        b = b1_scale*b1[v]
+        B1x = b.real
+        B1y = b.imag
+        w = GAMMA*(dB + grad[v]*loc[0] + grad[stride + v]*loc[1] + grad[2*stride + v]*loc[2])
+        mx = m[0]
+        my = m[1]
+        mz = m[2]
+        m[0] = mx + dt*(-T2_inv*mx + w*my - GAMMA*B1y*mz)
+        m[1] = my + dt*(-w*mx - T2_inv*my + GAMMA*B1x*mz)
+        m[2] = mz + dt*(GAMMA*B1y*mx - GAMMA*B1x*my - T1_inv*mz + T1_inv)
+
+
+cdef inline double complex _sample(const double* m, double PD, double complex ph) noexcept nogil:
+    """Phase-corrected signal of magnetization m (SpinGroup.get_m_signal)"""
+    cdef double complex s = PD*m[0] + 1j*(PD*m[1])
+    return s*ph
+
+
+cdef int64_t _readout_trapz(double* m, double complex* out, double complex ph, double dwell, int64_t n,
+                            double delay, const double* timing, const double* grad, int64_t nt, int64_t stride,
+                            double PD, double T1, double T2, const double* loc, double df) noexcept nogil:
+    """SpinGroup.readout_trapz(); adds the samples to out and returns their number
+
+    grad holds Gx, Gy, Gz at the nt time points, stride elements apart
+    """
+    cdef double h
+    cdef int64_t q
+    cdef int64_t k = 0
+    # ADC delay
+    if nt > 1:
+        h = 0.5*(timing[1] - timing[0])
+        _fpwg(m, h*(grad[0] + grad[1]), h*(grad[stride] + grad[stride + 1]),
+              h*(grad[2*stride] + grad[2*stride + 1]), delay, T1, T2, loc, df)
+    else:
+        _fpwg(m, 0.0, 0.0, 0.0, delay, T1, T2, loc, df)
+    h = 0.5*dwell
+    for q in range(1, nt):
+        if q <= n:
+            out[k] += _sample(m, PD, ph)
+            k += 1
+        if q + 1 < nt:
+            _fpwg(m, h*(grad[q] + grad[q + 1]), h*(grad[stride + q] + grad[stride + q + 1]),
+                  h*(grad[2*stride + q] + grad[2*stride + q + 1]), dwell, T1, T2, loc, df)
+        else:
+            _fpwg(m, 0.0, 0.0, 0.0, dwell, T1, T2, loc, df)
+    return k
+
+
+cdef double _interp(double x, const double* xp, const double* fp, int64_t n) noexcept nogil:
+    """numpy.interp() for a single point"""
+    cdef int64_t lo, hi, mid
+    cdef double slope, result
+    if x < xp[0]:
+        return fp[0]
+    if x >= xp[n - 1]:
+        return fp[n - 1]
+    # Largest lo with xp[lo] <= x
+    lo = 0
+    hi = n - 1
+    while hi - lo > 1:
+        mid = (lo + hi)//2
+        if xp[mid] <= x:
+            lo = mid
+        else:
+            hi = mid
+    if x == xp[lo]:
+        return fp[lo]
+    slope = (fp[lo + 1] - fp[lo])/(xp[lo + 1] - xp[lo])
+    result = slope*(x - xp[lo]) + fp[lo]
+    if isnan(result):
+        result = slope*(x - xp[lo + 1]) + fp[lo + 1]
+        if isnan(result) and fp[lo] == fp[lo + 1]:
+            result = fp[lo]
+    return result
+
+
+cdef double _interp_area(double t0, double dt_adc, int64_t npts, const double* timing, const double* g_axis,
+                         int64_t nt) noexcept nogil:
+    """Trapezoidal area of one gradient axis interpolated at t0 + dt_adc*(0..npts-1)"""
+    cdef double area = 0.0
+    cdef double g_prev = 0.0
+    cdef double g
+    cdef int64_t u
+    for u in range(npts):
+        g = _interp(t0 + u*dt_adc, timing, g_axis, nt)
+        if u > 0:
+            area += 0.5*dt_adc*(g_prev + g)
+        g_prev = g
+    return area
+
+
+cdef int64_t _readout(double* m, double complex* out, double complex ph, double dwell, int64_t n,
+                      double delay, const double* timing, const double* grad, int64_t nt, int64_t stride,
+                      double PD, double T1, double T2, const double* loc, double df) noexcept nogil:
+    """SpinGroup.readout() for arbitrary gradients; adds the samples to out and returns their number"""
+    cdef double dt_adc = timing[1] - timing[0]
+    cdef int64_t N_delay = <int64_t>(delay/dt_adc)
+    cdef int64_t N_dwell = <int64_t>(dwell/dt_adc)
+    cdef double dt_dwell = dwell/N_dwell if N_dwell > 0 else 0.0
+    cdef double adc_begin_time = delay
+    cdef int64_t q
+
+    # ADC delay
+    _fpwg(m, _interp_area(0.0, dt_adc, N_delay, timing, grad, nt),
+          _interp_area(0.0, dt_adc, N_delay, timing, grad + stride, nt),
+          _interp_area(0.0, dt_adc, N_delay, timing, grad + 2*stride, nt), delay, T1, T2, loc, df)
+
+    # Readout
+    for q in range(n):
+        out[q] += _sample(m, PD, ph)
+        _fpwg(m, _interp_area(adc_begin_time, dt_dwell, N_dwell + 1, timing, grad, nt),
+              _interp_area(adc_begin_time, dt_dwell, N_dwell + 1, timing, grad + stride, nt),
+              _interp_area(adc_begin_time, dt_dwell, N_dwell + 1, timing, grad + 2*stride, nt), dwell, T1, T2, loc, df)
+        adc_begin_time += dwell
+    return n
+
+
+cdef struct SeqArrays:
+    # Pointers into the arrays of a SeqInfo, see pulseq_seqinfo.SeqInfo
+    int64_t n_cmds
+    const int8_t* cmd_codes
+    const int64_t* cmd_index
+    const double* delay_t
+    const double* rf_dt
+    const int64_t* rf_offs
+    const double complex* rf_b1
+    const double* rf_grad
+    int64_t rf_stride
+    const double* adc_dwell
+    const int64_t* adc_n
+    const double* adc_delay
+    const double* adc_phase
+    const int8_t* adc_is_trap
+    const int64_t* adc_offs
+    const double* adc_timing
+    const double* adc_grad
+    int64_t adc_stride
+    const double* grad_area
+    const double* grad_t
+
+
+cdef class _SeqBuffers:
+    """Keeps double precision, C-contiguous copies of the arrays of a SeqInfo alive while SeqArrays points into them"""
+    cdef SeqArrays s
+    cdef list arrays
+
+    def __cinit__(self, seq_info):
+        self.arrays = []
+        self.s.n_cmds = len(seq_info.cmd_codes)
+        self.s.cmd_codes = <const int8_t*>self._ptr(seq_info.cmd_codes, np.int8)
+        self.s.cmd_index = <const int64_t*>self._ptr(seq_info.cmd_index, np.int64)
+        self.s.delay_t = <const double*>self._ptr(seq_info.delay_t, np.float64)
+        self.s.rf_dt = <const double*>self._ptr(seq_info.rf_dt, np.float64)
+        self.s.rf_offs = <const int64_t*>self._ptr(seq_info.rf_offs, np.int64)
+        self.s.rf_b1 = <const double complex*>self._ptr(seq_info.rf_b1, np.complex128)
+        self.s.rf_grad = <const double*>self._ptr(seq_info.rf_grad, np.float64)
+        self.s.rf_stride = seq_info.rf_grad.shape[1]
+        self.s.adc_dwell = <const double*>self._ptr(seq_info.adc_dwell, np.float64)
+        self.s.adc_n = <const int64_t*>self._ptr(seq_info.adc_n, np.int64)
+        self.s.adc_delay = <const double*>self._ptr(seq_info.adc_delay, np.float64)
+        self.s.adc_phase = <const double*>self._ptr(seq_info.adc_phase, np.float64)
+        self.s.adc_is_trap = <const int8_t*>self._ptr(seq_info.adc_is_trap, np.int8)
+        self.s.adc_offs = <const int64_t*>self._ptr(seq_info.adc_offs, np.int64)
+        self.s.adc_timing = <const double*>self._ptr(seq_info.adc_timing, np.float64)
+        self.s.adc_grad = <const double*>self._ptr(seq_info.adc_grad, np.float64)
+        self.s.adc_stride = seq_info.adc_grad.shape[1]
+        self.s.grad_area = <const double*>self._ptr(seq_info.grad_area, np.float64)
+        self.s.grad_t = <const double*>self._ptr(seq_info.grad_t, np.float64)
+
+    cdef const void* _ptr(self, a, dtype):
+        # An extra element keeps the pointer valid for empty pools
+        a = np.ascontiguousarray(a, dtype=dtype).ravel()
+        a = np.concatenate((a, np.zeros(1, dtype=dtype))) if a.size == 0 else a
+        self.arrays.append(a)
+        cdef const unsigned char[::1] view = a.view(np.uint8)
+        return <const void*>&view[0]
+
+
+cdef int64_t _run_commands(const SeqArrays* s, double* m, double PD, double T1, double T2, const double* loc,
+                           double df, double complex b1_scale, double complex* signal) noexcept nogil:
+    """Applies all commands to magnetization m, adding the readout samples to signal"""
+    cdef int64_t c, i, o0, nt
+    cdef int64_t k = 0
+    cdef double complex ph
+    for c in range(s.n_cmds):
+        i = s.cmd_index[c]
+        if s.cmd_codes[c] == CMD_DELAY:
+            # SpinGroup.delay()
+            _precess(m, 2*PI*df*s.delay_t[i], s.delay_t[i], max(0.0, T1), max(0.0, T2))
+        elif s.cmd_codes[c] == CMD_RF:
+            o0 = s.rf_offs[i]
+            _apply_rf(m, s.rf_b1 + o0, b1_scale, s.rf_grad + o0, s.rf_offs[i + 1] - o0, s.rf_stride, s.rf_dt[i],
+                      T1, T2, loc, df)
+        elif s.cmd_codes[c] == CMD_READOUT:
+            o0 = s.adc_offs[i]
+            nt = s.adc_offs[i + 1] - o0
+            ph = cos(s.adc_phase[i]) - 1j*sin(s.adc_phase[i])
+            if s.adc_is_trap[i] != 0:
+                k += _readout_trapz(m, signal + k, ph, s.adc_dwell[i], s.adc_n[i], s.adc_delay[i], s.adc_timing + o0,
+                                    s.adc_grad + o0, nt, s.adc_stride, PD, T1, T2, loc, df)
+            else:
+                k += _readout(m, signal + k, ph, s.adc_dwell[i], s.adc_n[i], s.adc_delay[i], s.adc_timing + o0,
+                              s.adc_grad + o0, nt, s.adc_stride, PD, T1, T2, loc, df)
+        elif s.cmd_codes[c] == CMD_GRAD:
+            _fpwg(m, s.grad_area[3*i], s.grad_area[3*i + 1], s.grad_area[3*i + 2], s.grad_t[i], T1, T2, loc, df)
+    return k
+
+
+def run_pulseq_commands(seq_info, double[::1] m, double PD, double T1, double T2, const double[::1] loc, double df,
+                        double complex b1_scale):
+    """Applies all commands of a SeqInfo to magnetization m (modified in place)
+
+    Same arguments and results as pulseq_blochsim_kernels.run_pulseq_commands().
+
+    Returns
+    -------
+    signal : numpy.ndarray
+        All readout samples concatenated, already corrected for ADC phase
+    lens : numpy.ndarray
+        Number of samples in each readout
+    """
+    cdef _SeqBuffers buffers = _SeqBuffers(seq_info)
+    lens = seq_info.readout_lengths()
+    # The extra sample keeps the output pointer valid for sequences without readouts
+    cdef Py_ssize_t n_samples = np.sum(lens)
+    signal = np.zeros(n_samples + 1, dtype=np.complex128)
+    cdef double complex[::1] signal_view = signal
+    with nogil:
+        _run_commands(&buffers.s, &m[0], PD, T1, T2, &loc[0], df, b1_scale, &signal_view[0])
+    return signal[:n_samples], lens
+
+
+def run_pulseq_commands_batch(seq_info, double[:, ::1] M, const double[::1] PD, const double[::1] T1,
+                              const double[::1] T2, const double[:, ::1] locs, const double[::1] df,
+                              double complex b1_scale=1, int num_threads=1):
+    """Applies all commands of a SeqInfo to many spin groups in parallel and sums their signals
+
+    Parameters
+    ----------
+    seq_info : SeqInfo
+        Commands generated by store_pulseq_commands()
+    M : numpy.ndarray
+        Nvox x 3 array of magnetizations; modified in place
+    PD, T1, T2, df : numpy.ndarray
+        Spin group parameters of length Nvox
+    locs : numpy.ndarray
+        Nvox x 3 array of spin group locations in meters
+    b1_scale : complex, optional
+        Transmit B1 scaling applied to all RF pulses; default is 1
+    num_threads : int, optional
+        Number of OpenMP threads; default is 1
+
+    Returns
+    -------
+    signal : numpy.ndarray
+        All readout samples concatenated and summed over spin groups
+    lens : numpy.ndarray
+        Number of samples in each readout
+    """
+    cdef _SeqBuffers buffers = _SeqBuffers(seq_info)
+    lens = seq_info.readout_lengths()
+    num_threads = max(1, num_threads)
+    # One accumulator per thread; the extra sample keeps the row pointers valid for sequences without readouts
+    cdef Py_ssize_t n_samples = np.sum(lens)
+    acc = np.zeros((num_threads, n_samples + 1), dtype=np.complex128)
+    cdef double complex[:, ::1] acc_view = acc
+    cdef const SeqArrays* s = &buffers.s
+    cdef Py_ssize_t v
+    for v in prange(M.shape[0], nogil=True, num_threads=num_threads, schedule='dynamic'):
+        _run_commands(s, &M[v, 0], PD[v], T1[v], T2[v], &locs[v, 0], df[v], b1_scale, &acc_view[threadid(), 0])
+    return acc[:, :n_samples].sum(axis=0), lens
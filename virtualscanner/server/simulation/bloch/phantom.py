@@ -4,9 +4,7 @@ Numerical phantom generation and access
 """
 
 import numpy as np
-import scipy.signal as ss
 import h5py
-import matplotlib.pyplot as plt
 from scipy.io import savemat, loadmat
 
 class Phantom:
@@ -368,6 +366,7 @@ class BrainwebPhantom(Phantom):
         else:
             ax = [0,1,2]
 
+        import scipy.signal as ss
         for v in range(len(ax)):
             PDmap = ss.decimate(PDmap, dsf, axis=ax[v], ftype='fir')
             T1map = ss.decimate(T1map, dsf, axis=ax[v], ftype='fir')
@@ -439,6 +438,54 @@ class SpheresArrayPlanarPhantom(DTTPhantom):
         super().__init__(type_map, type_params, vsize, loc=loc)
 
 
+class PhantomShared(Phantom):
+    """Phantom that pickles as handles to its arrays in shared memory
+
+    Worker processes that receive it attach zero-copy views of the arrays instead of unpickling
+    a copy of each map (see util.share_arrays()); all Phantom methods work unchanged.
+    The creating process keeps using the original arrays and calls close() once the workers are done.
+
+    """
+
+    @classmethod
+    def from_phantom(cls, phantom):
+        """Copies all arrays of a phantom into a new shared memory block
+
+        Parameters
+        ----------
+        phantom : Phantom
+            Phantom to share
+
+        Returns
+        -------
+        shared : PhantomShared
+            Phantom with the same attributes and a shared memory block to hand to worker processes
+
+        """
+        # Imported here so that phantoms load on Pythons without multiprocessing.shared_memory
+        from virtualscanner.server.simulation.bloch.util import share_arrays
+        shared = cls.__new__(cls)
+        shared.__dict__.update(vars(phantom))
+        shared._handles, shared._shm = share_arrays(vars(phantom))
+        return shared
+
+    def close(self):
+        """Frees the shared memory block; only to be called by the process that created it"""
+        self._shm.close()
+        self._shm.unlink()
+
+    def __getstate__(self):
+        return self._handles
+
+    def __setstate__(self, handles):
+        from virtualscanner.server.simulation.bloch.util import attach_arrays
+        attrs, shm = attach_arrays(handles)
+        self.__dict__.update(attrs)
+        self._handles = handles
+        # Keeps the attached block alive as long as this phantom
+        self._shm = shm
+
+
 def makeSphericalPhantom(n,fov,T1s,T2s,PDs,radii,loc=(0,0,0)):
     """Make a spherical phantom with concentric layers
 
@@ -676,6 +723,7 @@ def makeCustomCylindricalPhantom(T1T2PD0, PDs, T1s, T2s, T1T2PD1=None, dim=2,n=1
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
     # pht = makeCylindricalPhantom(dim=2, n=16, dir='z', loc=0, fov = 0.25)
     # #plt.imshow(pht.PDmap)
     # #plt.show()
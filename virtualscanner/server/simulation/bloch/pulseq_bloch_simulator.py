@@ -17,7 +17,6 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import time
 import virtualscanner.server.simulation.bloch.phantom as pht
-import multiprocessing as mp
 import virtualscanner.server.simulation.bloch.pulseq_library as psl
 import argparse
 from math import pi
@@ -131,19 +130,15 @@ if __name__ == '__main__':
 
     # Time the code: Tic
     start_time = time.time()
-    loc_ind_list = myphantom.get_list_inds()
+    df_map = np.zeros(myphantom.get_shape())
+    for loc_ind in myphantom.get_list_inds():
+        df_map[loc_ind] = GAMMA_BAR*dBmap(myphantom.get_location(loc_ind))
 
     # Get seq info
     seq_info = blcsim.store_pulseq_commands(myseq)
 
-    # Initiate multiprocessing pool
-    pool = mp.Pool(mp.cpu_count())
-
-    # Multiprocessing simulation
-    results = pool.starmap_async(blcsim.sim_single_spingroup, [(loc_ind, GAMMA_BAR*dBmap(myphantom.get_location(loc_ind)), myphantom, seq_info) for loc_ind in loc_ind_list]).get()
-    pool.close()
-    # Add up signal across all SpinGroups
-    raw_signal = np.sum(results,axis=0)
+    # Multiprocessing simulation, summed across all SpinGroups
+    raw_signal = blcsim.simulate_phantom(myphantom, seq_info, df_map)
 
     # Time the code: Toc
     print("Simulation complete!")
@@ -0,0 +1,230 @@
+# Copyright of the Board of Trustees of Columbia University in the City of New York
+"""
+Compiled kernels for applying pulseq commands to a single spin group
+
+The per-block Python dispatch of apply_pulseq_commands() is replaced by a single Numba-compiled loop
+over the typed arrays of a SeqInfo (see pulseq_seqinfo). SpinGroup.delay(), fpwg(), apply_rf(), readout() and readout_trapz() are ported
+as free functions acting on a 3-element magnetization vector.
+
+Numba is optional: when it is not installed, HAS_NUMBA is False and the simulation
+falls back to the SpinGroup methods. When the ahead-of-time compiled _blochcore extension
+has been built (see setup.py), it is used instead of the Numba kernels.
+"""
+
+import numpy as np
+from math import pi
+
+from virtualscanner.server.simulation.bloch.pulseq_seqinfo import CMD_DELAY, CMD_RF, CMD_READOUT, CMD_GRAD
+# The SpinGroup constants, so that both paths give identical results; Numba freezes them at compile time
+from virtualscanner.server.simulation.bloch.spingroup_ps import GAMMA, GAMMA_BAR
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """Stand-in decorator that leaves the function uncompiled"""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+try:
+    from virtualscanner.server.simulation.bloch import _blochcore
+    HAS_BLOCHCORE = True
+except ImportError:
+    _blochcore = None
+    HAS_BLOCHCORE = False
+
+# Whether apply_packed_commands() runs compiled code
+HAS_KERNEL = HAS_BLOCHCORE or HAS_NUMBA
+
+
+def apply_packed_commands(isc, seq_info, b1_scale=1):
+    """Applies sequence commands to a SpinGroup using the compiled kernel
+
+    Updates isc.m and appends one complex array per readout to isc.signal,
+    exactly as the SpinGroup methods would. The Cython extension is used when it is built,
+    the Numba kernel otherwise.
+
+    Parameters
+    ----------
+    isc : SpinGroup
+        The affected spin group
+    seq_info : SeqInfo
+        Commands generated by store_pulseq_commands()
+    b1_scale : complex, optional
+        Transmit B1 scaling applied to all RF pulses; default is 1
+
+    """
+    m = np.array(isc.m, dtype=np.float64).reshape(3)
+    loc = np.array(isc.loc, dtype=np.float64)
+    run = _blochcore.run_pulseq_commands if HAS_BLOCHCORE else run_pulseq_commands
+    signal, lens = run(seq_info, m, float(isc.PD), float(isc.T1), float(isc.T2), loc, float(isc.df),
+                       complex(b1_scale))
+    isc.m = m.reshape((3, 1))
+    isc.signal.extend(np.split(signal, np.cumsum(lens)[:-1]))
+
+
+@njit(cache=True)
+def _precess(m, phi, t, T1, T2):
+    """Free precession by angle phi with relaxation over time t (SpinGroup.fpwg)"""
+    E1 = 1.0 if T1 == 0 else np.exp(-t/T1)
+    E2 = 1.0 if T2 == 0 else np.exp(-t/T2)
+    C = np.cos(phi)
+    S = np.sin(phi)
+    mx = m[0]
+    my = m[1]
+    m[0] = E2*(C*mx + S*my)
+    m[1] = E2*(-S*mx + C*my)
+    m[2] = E1*m[2] + 1 - E1
+
+
+@njit(cache=True)
+def _delay(m, t, T1, T2, df):
+    """SpinGroup.delay()"""
+    _precess(m, 2*pi*df*t, t, max(0.0, T1), max(0.0, T2))
+
+
+@njit(cache=True)
+def _fpwg(m, ax, ay, az, t, T1, T2, loc, df):
+    """SpinGroup.fpwg() with gradient areas (ax, ay, az)"""
+    phi = GAMMA*(loc[0]*ax + loc[1]*ay + loc[2]*az) + 2*pi*df*t
+    _precess(m, phi, t, T1, T2)
+
+
+@njit(cache=True)
+def _apply_rf(m, b1, b1_scale, grad, dt, T1, T2, loc, df):
+    """SpinGroup.apply_rf(); grad is the 3 x len(b1) gradient shape"""
+    dB = df/GAMMA_BAR
+    T1_inv = 1/T1 if T1 > 0 else 0.0
+    T2_inv = 1/T2 if T2 > 0 else 0.0
+    for v in range(len(b1)):
+        b = b1_scale*b1[v]
+        B1x = b.real
+        B1y = b.imag
+        glocp = grad[0, v]*loc[0] + grad[1, v]*loc[1] + grad[2, v]*loc[2]
+        w = GAMMA*(dB + glocp)
+        mx = m[0]
+        my = m[1]
+        mz = m[2]
+        m[0] = mx + dt*(-T2_inv*mx + w*my - GAMMA*B1y*mz)
+        m[1] = my + dt*(-w*mx - T2_inv*my + GAMMA*B1x*mz)
+        m[2] = mz + dt*(GAMMA*B1y*mx - GAMMA*B1x*my - T1_inv*mz + T1_inv)
+
+
+@njit(cache=True)
+def _readout_trapz(m, out, dwell, n, delay, timing, grad, PD, T1, T2, loc, df):
+    """SpinGroup.readout_trapz(); returns the number of samples written to out"""
+    nt = len(timing)
+    # ADC delay
+    if nt > 1:
+        h = 0.5*(timing[1] - timing[0])
+        _fpwg(m, h*(grad[0, 0] + grad[0, 1]), h*(grad[1, 0] + grad[1, 1]), h*(grad[2, 0] + grad[2, 1]),
+              delay, T1, T2, loc, df)
+    else:
+        _fpwg(m, 0.0, 0.0, 0.0, delay, T1, T2, loc, df)
+    k = 0
+    for q in range(1, nt):
+        if q <= n:
+            out[k] = PD*(m[0] + 1j*m[1])
+            k += 1
+        if q + 1 < nt:
+            h = 0.5*dwell
+            _fpwg(m, h*(grad[0, q] + grad[0, q + 1]), h*(grad[1, q] + grad[1, q + 1]),
+                  h*(grad[2, q] + grad[2, q + 1]), dwell, T1, T2, loc, df)
+        else:
+            _fpwg(m, 0.0, 0.0, 0.0, dwell, T1, T2, loc, df)
+    return k
+
+
+@njit(cache=True)
+def _interp_area(t0, dt_adc, npts, timing, g_axis):
+    """Trapezoidal area of one gradient axis interpolated at t0 + dt_adc*(0..npts-1)"""
+    area = 0.0
+    g_prev = 0.0
+    for u in range(npts):
+        g = np.interp(t0 + u*dt_adc, timing, g_axis)
+        if u > 0:
+            area += 0.5*dt_adc*(g_prev + g)
+        g_prev = g
+    return area
+
+
+@njit(cache=True)
+def _readout(m, out, dwell, n, delay, timing, grad, PD, T1, T2, loc, df):
+    """SpinGroup.readout() for arbitrary gradients; returns the number of samples written to out"""
+    dt_adc = timing[1] - timing[0]
+    gx = grad[0].astype(np.float64)
+    gy = grad[1].astype(np.float64)
+    gz = grad[2].astype(np.float64)
+
+    # ADC delay
+    N_delay = int(delay/dt_adc)
+    _fpwg(m, _interp_area(0.0, dt_adc, N_delay, timing, gx), _interp_area(0.0, dt_adc, N_delay, timing, gy),
+          _interp_area(0.0, dt_adc, N_delay, timing, gz), delay, T1, T2, loc, df)
+
+    # Readout
+    adc_begin_time = delay
+    N_dwell = int(dwell/dt_adc)
+    dt_dwell = dwell/N_dwell if N_dwell > 0 else 0.0
+    for q in range(n):
+        out[q] = PD*(m[0] + 1j*m[1])
+        _fpwg(m, _interp_area(adc_begin_time, dt_dwell, N_dwell + 1, timing, gx),
+              _interp_area(adc_begin_time, dt_dwell, N_dwell + 1, timing, gy),
+              _interp_area(adc_begin_time, dt_dwell, N_dwell + 1, timing, gz), dwell, T1, T2, loc, df)
+        adc_begin_time += dwell
+    return n
+
+
+@njit(cache=True)
+def run_pulseq_commands(seq_info, m, PD, T1, T2, loc, df, b1_scale):
+    """Applies all commands of a SeqInfo to magnetization m (modified in place)
+
+    Returns
+    -------
+    signal : numpy.ndarray
+        All readout samples concatenated, already corrected for ADC phase
+    lens : numpy.ndarray
+        Number of samples in each readout
+    """
+    # Repeated readouts share their pool entry, so count samples per readout command
+    readouts = seq_info.cmd_index[seq_info.cmd_codes == CMD_READOUT]
+    signal = np.zeros(np.sum(seq_info.adc_n[readouts]), dtype=np.complex128)
+    lens = np.zeros(len(readouts), dtype=np.int64)
+
+    k = 0
+    r = 0
+    for c in range(len(seq_info.cmd_codes)):
+        code = seq_info.cmd_codes[c]
+        i = seq_info.cmd_index[c]
+        if code == CMD_DELAY:
+            _delay(m, seq_info.delay_t[i], T1, T2, df)
+        elif code == CMD_RF:
+            o0, o1 = seq_info.rf_offs[i], seq_info.rf_offs[i + 1]
+            _apply_rf(m, seq_info.rf_b1[o0:o1], b1_scale, seq_info.rf_grad[:, o0:o1], seq_info.rf_dt[i],
+                      T1, T2, loc, df)
+        elif code == CMD_READOUT:
+            o0, o1 = seq_info.adc_offs[i], seq_info.adc_offs[i + 1]
+            n = seq_info.adc_n[i]
+            out = signal[k:k + n]
+            if seq_info.adc_is_trap[i] != 0:
+                ns = _readout_trapz(m, out, seq_info.adc_dwell[i], n, seq_info.adc_delay[i],
+                                    seq_info.adc_timing[o0:o1], seq_info.adc_grad[:, o0:o1], PD, T1, T2, loc, df)
+            else:
+                ns = _readout(m, out, seq_info.adc_dwell[i], n, seq_info.adc_delay[i],
+                              seq_info.adc_timing[o0:o1], seq_info.adc_grad[:, o0:o1], PD, T1, T2, loc, df)
+            ph = np.exp(-1j*seq_info.adc_phase[i])
+            for u in range(ns):
+                out[u] *= ph
+            # Trapezoid readouts produce fewer samples than requested when the gradient is too short;
+            # the next readout then simply starts at k + ns
+            lens[r] = ns
+            r += 1
+            k += ns
+        elif code == CMD_GRAD:
+            _fpwg(m, seq_info.grad_area[i, 0], seq_info.grad_area[i, 1], seq_info.grad_area[i, 2],
+                  seq_info.grad_t[i], T1, T2, loc, df)
+
+    return signal[:k], lens
@@ -0,0 +1,305 @@
+# Copyright of the Board of Trustees of Columbia University in the City of New York
+"""
+Struct-of-arrays representation of a pulseq sequence for simulation
+
+A sequence becomes a stream of command codes, one per block, and one pool of typed arrays per command type.
+cmd_index[c] tells which entry of its pool command c uses, so repeated blocks can share one entry; waveforms of
+varying length (RF pulses, readout gradients) are stored back to back with offsets into the pool, so the whole
+sequence is a handful of flat arrays that can be handed to compiled kernels, pickled, or placed in shared memory
+as is.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+# Command codes
+CMD_DELAY = 0
+CMD_RF = 1
+CMD_READOUT = 2
+CMD_GRAD = 3
+CMD_CODES = {'d': CMD_DELAY, 'p': CMD_RF, 'r': CMD_READOUT, 'g': CMD_GRAD}
+CMD_CHARS = 'dprg'
+
+
+class SeqInfo(NamedTuple):
+    """Sequence commands produced by store_pulseq_commands()
+
+    Attributes
+    ----------
+    cmd_codes : numpy.ndarray
+        int8 command code of each block (CMD_DELAY, CMD_RF, CMD_READOUT, or CMD_GRAD)
+    cmd_index : numpy.ndarray
+        Index of each command into the pool of its type; repeated RF pulses and readouts share an index
+    delay_t : numpy.ndarray
+        Delay durations in seconds
+    rf_dt : numpy.ndarray
+        RF raster time of each pulse in seconds
+    rf_offs : numpy.ndarray
+        Pulse p occupies samples rf_offs[p]:rf_offs[p+1] of rf_b1 and rf_grad
+    rf_b1 : numpy.ndarray
+        Complex B1 samples of all pulses in Tesla
+    rf_grad : numpy.ndarray
+        3 x N gradients during all pulses in Tesla/meter
+    adc_dwell, adc_n, adc_delay, adc_phase : numpy.ndarray
+        Dwell time, number of samples, delay, and phase offset of each readout
+    adc_is_trap : numpy.ndarray
+        int8 flag of readouts with trapezoid gradients (SpinGroup.readout_trapz()) instead of arbitrary ones
+    adc_offs : numpy.ndarray
+        Readout r occupies points adc_offs[r]:adc_offs[r+1] of adc_timing and adc_grad
+    adc_timing : numpy.ndarray
+        Gradient time points of all readouts in seconds
+    adc_grad : numpy.ndarray
+        3 x N gradients of all readouts in Tesla/meter
+    grad_area : numpy.ndarray
+        Nblocks x 3 gradient areas of free precession blocks in seconds*Tesla/meter
+    grad_t : numpy.ndarray
+        Durations of free precession blocks in seconds
+    grad_raster_time : float
+        Gradient raster time of the sequence in seconds
+    """
+    cmd_codes: np.ndarray
+    cmd_index: np.ndarray
+    delay_t: np.ndarray
+    rf_dt: np.ndarray
+    rf_offs: np.ndarray
+    rf_b1: np.ndarray
+    rf_grad: np.ndarray
+    adc_dwell: np.ndarray
+    adc_n: np.ndarray
+    adc_delay: np.ndarray
+    adc_phase: np.ndarray
+    adc_is_trap: np.ndarray
+    adc_offs: np.ndarray
+    adc_timing: np.ndarray
+    adc_grad: np.ndarray
+    grad_area: np.ndarray
+    grad_t: np.ndarray
+    grad_raster_time: float
+
+    @property
+    def commands(self):
+        """One character per command ('d', 'p', 'r', or 'g')"""
+        return ''.join(CMD_CHARS[code] for code in self.cmd_codes.tolist())
+
+    def get_command(self, c):
+        """Returns command c as its character and list of parameters, e.g. for inspecting a sequence
+
+        Parameters
+        ----------
+        c : int
+            Index of the command
+
+        Returns
+        -------
+        cstr : str
+            'd', 'p', 'r', or 'g'
+        cpars : list
+            'd' : [t]
+            'p' : [b1, grad, dt]
+            'r' : [dwell, n, delay, grad, timing, grad_type, phase]
+            'g' : [grad_area, t]
+        """
+        code, i = self.cmd_codes[c], self.cmd_index[c]
+        if code == CMD_DELAY:
+            return 'd', [self.delay_t[i]]
+        if code == CMD_RF:
+            o0, o1 = self.rf_offs[i], self.rf_offs[i + 1]
+            return 'p', [self.rf_b1[o0:o1], self.rf_grad[:, o0:o1], self.rf_dt[i]]
+        if code == CMD_READOUT:
+            o0, o1 = self.adc_offs[i], self.adc_offs[i + 1]
+            return 'r', [self.adc_dwell[i], int(self.adc_n[i]), self.adc_delay[i], self.adc_grad[:, o0:o1],
+                         self.adc_timing[o0:o1], 'trap' if self.adc_is_trap[i] else 'grad', self.adc_phase[i]]
+        return 'g', [self.grad_area[i], self.grad_t[i]]
+
+    def readout_lengths(self):
+        """Number of samples of each readout command in order; trapezoid readouts stop at the end of their gradient"""
+        n_points = np.diff(self.adc_offs)
+        lens = np.where(self.adc_is_trap != 0, np.minimum(self.adc_n, np.maximum(n_points - 1, 0)), self.adc_n)
+        return lens[self.cmd_index[self.cmd_codes == CMD_READOUT]]
+
+
+class SeqInfoBuilder:
+    """Collects sequence commands one block at a time and packs them into a SeqInfo
+
+    Parameters
+    ----------
+    grad_raster_time : float, optional
+        Gradient raster time of the sequence in seconds; default is 0
+    dtype : numpy.dtype, optional
+        Floating point type of the stored RF and gradient waveforms and gradient areas; default is numpy.float64
+    merge_precession : bool, optional
+        Whether to merge each run of consecutive delays and gradient-only blocks into a single gradient command
+        Default is True; free precession blocks compose exactly, as gradient areas and durations add up
+        and the relaxation factors of successive intervals multiply to those of the total duration
+
+    Notes
+    -----
+    Every add_*() method takes an optional key identifying the block. repeat(key) then adds the same
+    command again without its parameters having to be computed, and RF pulses and readouts reuse their
+    pool entry instead of storing another copy of their waveforms.
+
+    """
+
+    def __init__(self, grad_raster_time=0, dtype=np.float64, merge_precession=True):
+        self.grad_raster_time = grad_raster_time
+        self.dtype = dtype
+        self.merge_precession = merge_precession
+        self.cmd_codes = []
+        self.cmd_index = []
+        self.delay_t = []
+        self.rf = []
+        self.adc = []
+        self.grad_area = []
+        self.grad_t = []
+        # key -> (command code, pool index for RF pulses and readouts or arguments for precession)
+        self._repeats = {}
+
+    def _append(self, code, pool):
+        self.cmd_codes.append(code)
+        self.cmd_index.append(len(pool))
+
+    def _remember(self, key, code, value):
+        if key is not None:
+            self._repeats[key] = (code, value)
+
+    def repeat(self, key):
+        """Adds the command stored under key again
+
+        Parameters
+        ----------
+        key : hashable
+            Key passed to an earlier add_*() call
+
+        Returns
+        -------
+        found : bool
+            False if no command was stored under key, in which case nothing is added
+        """
+        if key not in self._repeats:
+            return False
+        code, value = self._repeats[key]
+        if code == CMD_DELAY:
+            self.add_delay(value)
+        elif code == CMD_GRAD:
+            self.add_grad(*value)
+        else:
+            self.cmd_codes.append(code)
+            self.cmd_index.append(value)
+        return True
+
+    def _pop_precession(self):
+        """Removes the last command if it is a delay or gradient block and returns its (grad_area, t)"""
+        if not self.merge_precession or not self.cmd_codes or self.cmd_codes[-1] not in (CMD_DELAY, CMD_GRAD):
+            return None
+        code = self.cmd_codes.pop()
+        self.cmd_index.pop()
+        if code == CMD_DELAY:
+            return np.zeros(3), self.delay_t.pop()
+        return self.grad_area.pop(), self.grad_t.pop()
+
+    def add_delay(self, t, key=None):
+        """Adds a delay of t seconds (SpinGroup.delay())"""
+        self._remember(key, CMD_DELAY, t)
+        prev = self._pop_precession()
+        if prev is None:
+            self._append(CMD_DELAY, self.delay_t)
+            self.delay_t.append(t)
+        else:
+            self._append(CMD_GRAD, self.grad_t)
+            self.grad_area.append(prev[0])
+            self.grad_t.append(prev[1] + t)
+
+    def add_grad(self, grad_area, t, key=None):
+        """Adds free precession over t seconds under gradients of total area grad_area (SpinGroup.fpwg())"""
+        grad_area = np.asarray(grad_area, dtype=np.float64)
+        self._remember(key, CMD_GRAD, (grad_area, t))
+        prev = self._pop_precession()
+        if prev is not None:
+            grad_area = grad_area + prev[0]
+            t = prev[1] + t
+        self._append(CMD_GRAD, self.grad_t)
+        self.grad_area.append(grad_area)
+        self.grad_t.append(t)
+
+    def add_rf(self, b1, grad, dt, key=None):
+        """Adds an RF pulse with complex samples b1 and 3 x len(b1) gradients grad (SpinGroup.apply_rf())"""
+        self._remember(key, CMD_RF, len(self.rf))
+        self._append(CMD_RF, self.rf)
+        self.rf.append((b1, grad, dt))
+
+    def add_readout(self, dwell, n, delay, grad, timing, grad_type, phase, key=None):
+        """Adds a readout (SpinGroup.readout_trapz() if grad_type is 'trap', SpinGroup.readout() otherwise)"""
+        self._remember(key, CMD_READOUT, len(self.adc))
+        self._append(CMD_READOUT, self.adc)
+        self.adc.append((dwell, n, delay, grad, timing, grad_type == 'trap', phase))
+
+    def build(self):
+        """Packs the collected commands
+
+        Returns
+        -------
+        seq_info : SeqInfo
+            Commands in struct-of-arrays form
+        """
+        dtype = self.dtype
+        c_dtype = np.result_type(dtype, np.complex64)
+        rf_dt = [r[2] for r in self.rf]
+        rf_b1 = [np.ravel(r[0]) for r in self.rf]
+        rf_grad = [np.reshape(r[1], (3, -1)) for r in self.rf]
+        adc_grad = [np.reshape(a[3], (3, -1)) for a in self.adc]
+        adc_timing = [np.ravel(a[4]) for a in self.adc]
+
+        return SeqInfo(cmd_codes=np.array(self.cmd_codes, dtype=np.int8),
+                       cmd_index=np.array(self.cmd_index, dtype=np.int64),
+                       delay_t=np.array(self.delay_t, dtype=np.float64),
+                       rf_dt=np.array(rf_dt, dtype=np.float64),
+                       rf_offs=_offsets(rf_b1),
+                       rf_b1=np.concatenate(rf_b1).astype(c_dtype) if rf_b1 else np.zeros(0, dtype=c_dtype),
+                       rf_grad=np.concatenate(rf_grad, axis=1).astype(dtype) if rf_grad else np.zeros((3, 0), dtype),
+                       adc_dwell=np.array([a[0] for a in self.adc], dtype=np.float64),
+                       adc_n=np.array([a[1] for a in self.adc], dtype=np.int64),
+                       adc_delay=np.array([a[2] for a in self.adc], dtype=np.float64),
+                       adc_phase=np.array([a[6] for a in self.adc], dtype=np.float64),
+                       adc_is_trap=np.array([a[5] for a in self.adc], dtype=np.int8),
+                       adc_offs=_offsets(adc_timing),
+                       adc_timing=np.concatenate(adc_timing).astype(np.float64) if adc_timing else np.zeros(0),
+                       adc_grad=np.concatenate(adc_grad, axis=1).astype(dtype) if adc_grad else np.zeros((3, 0), dtype),
+                       grad_area=np.array(self.grad_area, dtype=dtype).reshape((-1, 3)),
+                       grad_t=np.array(self.grad_t, dtype=np.float64),
+                       grad_raster_time=self.grad_raster_time)
+
+
+def make_seq_info(commands, params, grad_raster_time=0, dtype=np.float64, merge_precession=False):
+    """Builds a SeqInfo from commands and parameters in the list form of SeqInfo.get_command()
+
+    Parameters
+    ----------
+    commands : str
+        One character per command ('d', 'p', 'r', or 'g')
+    params : list
+        Parameters of each command, as returned by SeqInfo.get_command()
+    grad_raster_time : float, optional
+        Gradient raster time of the sequence in seconds; default is 0
+    dtype : numpy.dtype, optional
+        Floating point type of the stored waveforms; default is numpy.float64
+    merge_precession : bool, optional
+        Whether to merge runs of delays and gradient blocks; default is False
+
+    Returns
+    -------
+    seq_info : SeqInfo
+        Commands in struct-of-arrays form
+    """
+    builder = SeqInfoBuilder(grad_raster_time=grad_raster_time, dtype=dtype, merge_precession=merge_precession)
+    add = {'d': builder.add_delay, 'p': builder.add_rf, 'r': builder.add_readout, 'g': builder.add_grad}
+    for cstr, cpars in zip(commands, params):
+        add[cstr](*cpars)
+    return builder.build()
+
+
+def _offsets(chunks):
+    """Offsets of arrays stored back to back, with one more entry than there are arrays"""
+    offs = np.zeros(len(chunks) + 1, dtype=np.int64)
+    offs[1:] = np.cumsum([len(chunk) for chunk in chunks])
+    return offs
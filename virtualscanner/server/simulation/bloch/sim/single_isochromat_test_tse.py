@@ -18,11 +18,12 @@ if __name__ == '__main__':
     myseq = Sequence()
     myseq.read('seq_validation_files/tse32_zero.seq')
 
-    seq_info =  blcsim.store_pulseq_commands(myseq)
-    print(seq_info['commands'][35])
-    print((seq_info['params'][35][4]))
+    seq_info =  blcsim.store_pulseq_commands(myseq, merge_precession=False)
+    print(seq_info.commands[35])
+    print((seq_info.get_command(35)[1][4]))
 
-    seq_info = blcsim.store_pulseq_commands(myseq)
+    # Keep one stored magnetization per block
+    seq_info = blcsim.store_pulseq_commands(myseq, merge_precession=False)
 
     isc = sg.NumSolverSpinGroup(loc=(0,0,0), pdt1t2=(1,0.5,0.5),df=0)
     m_store = blcsim.apply_pulseq_commands(isc,seq_info,store_m=True)
@@ -1,8 +1,6 @@
 # Copyright of the Board of Trustees of Columbia University in the City of New York
 
 import numpy as np
-from scipy.integrate import solve_ivp
-from scipy.interpolate import interp1d
 from virtualscanner.server.simulation.bloch.util import combine_gradients
 GAMMA = 2*42.58e6 * np.pi
 GAMMA_BAR = 42.58e6
@@ -111,6 +109,43 @@ class SpinGroup:
                       [0, 0, E1]])
         self.m = A@self.m + [[0],[0],[1 - E1]]
 
+    def _fpwg_samples(self, grad_areas, t, n):
+        """Applies fpwg() over consecutive intervals of equal length, sampling the signal before each
+
+        Every interval rotates the transverse magnetization by its phase and scales it by E2, while Mz
+        relaxes with E1 independently of the rotation; all intermediate magnetizations thus follow in
+        closed form from one cumulative sum of the phases instead of one fpwg() call per interval.
+        This function changes self.m.
+
+        Parameters
+        ----------
+        grad_areas : numpy.ndarray
+            3 x N array of gradient areas of the N intervals in seconds*Tesla/meter
+        t : float
+            Duration of each interval in seconds
+        n : int
+            Number of samples; at most N are taken
+
+        Returns
+        -------
+        signal_1D : numpy.ndarray
+            Complex signal at the start of the first min(n, N) intervals
+
+        """
+        x,y,z = self.loc
+        phi = GAMMA*(x*grad_areas[0]+y*grad_areas[1]+z*grad_areas[2])+2*np.pi*self.df*t
+        E1 = 1 if self.T1 == 0 else np.exp(-t/self.T1)
+        E2 = 1 if self.T2 == 0 else np.exp(-t/self.T2)
+        k = np.arange(len(phi) + 1)
+        m_xy = (self.m[0,0] + 1j*self.m[1,0]) * E2**k * np.exp(-1j*np.concatenate(([0], np.cumsum(phi))))
+        m_all = np.array([m_xy.real, m_xy.imag, 1 + (self.m[2,0] - 1)*E1**k])
+
+        # Sample through get_m_signal(), which subclasses may override
+        self.m = m_all[:,:min(n, len(phi))]
+        signal_1D = np.reshape(self.get_m_signal(), -1)
+        self.m = m_all[:,-1:]
+        return signal_1D
+
     def delay(self, t):
         """Applies a time passage to the spin group
 
@@ -330,15 +365,14 @@ class SpinGroup:
 
         """
 
-        signal_1D = []
         # ADC delay
         self.fpwg(np.trapz(y=grad[:,0:2], x=timing[0:2]), delay)
-        for q in range(1, len(timing)):
-            if q <= n:
-                signal_1D.append(self.get_m_signal())
-            self.fpwg(np.trapz(y=grad[:,q:q+2], dx=dwell), dwell)
+        # Gradient areas of the dwell intervals between time points; the last interval has no area
+        dwell_areas = np.zeros((3, len(timing) - 1))
+        dwell_areas[:,:-1] = dwell*(grad[:,2:] + grad[:,1:-1])/2
+        signal_1D = self._fpwg_samples(dwell_areas, dwell, n)
 
-        signal_1D_ref = np.array(signal_1D) * np.exp(-1j*phase)
+        signal_1D_ref = signal_1D * np.exp(-1j*phase)
 
         self.signal.append(signal_1D_ref)
 
@@ -367,7 +401,6 @@ class SpinGroup:
 
         """
 
-        signal_1D = []
         # ADC raster time assuming timing is uniformly spaced
         dt_adc = timing[1] - timing[0]
 
@@ -381,20 +414,16 @@ class SpinGroup:
         # ADC delay
         self.fpwg(np.trapz(y=delay_grads, x=delay_times), delay)
 
-        # Readout
-        adc_begin_time = delay
+        # Readout: n x (N_dwell+1) time points, one row per dwell interval
         N_dwell = int(dwell / dt_adc)
-        for q in range(n):
-            signal_1D.append(self.get_m_signal())
-            dwell_times = adc_begin_time + np.linspace(0,dwell,N_dwell+1,endpoint=True)
-            dwell_grads = np.zeros((3, N_dwell+1))
-            dwell_grads[0,:] = np.interp(dwell_times, timing, grad[0,:])
-            dwell_grads[1,:] = np.interp(dwell_times, timing, grad[1,:])
-            dwell_grads[2,:] = np.interp(dwell_times, timing, grad[2,:])
-            self.fpwg(np.trapz(y=dwell_grads, x=dwell_times), dwell)
-            adc_begin_time += dwell
-
-        signal_1D_ref = np.array(signal_1D) * np.exp(-1j*phase)
+        dwell_times = (delay + dwell*np.arange(n))[:,np.newaxis] + np.linspace(0,dwell,N_dwell+1,endpoint=True)
+        dwell_grads = np.zeros((3, n, N_dwell+1))
+        dwell_grads[0] = np.interp(dwell_times, timing, grad[0,:])
+        dwell_grads[1] = np.interp(dwell_times, timing, grad[1,:])
+        dwell_grads[2] = np.interp(dwell_times, timing, grad[2,:])
+        signal_1D = self._fpwg_samples(np.trapz(y=dwell_grads, x=dwell_times), dwell, n)
+
+        signal_1D_ref = signal_1D * np.exp(-1j*phase)
 
         self.signal.append(signal_1D_ref)
 
@@ -405,6 +434,7 @@ class NumSolverSpinGroup(SpinGroup):
     @staticmethod
     def interpolate_waveforms(grads_shape, pulse_shape, dt):
         # Helper function to generate continuous waveforms
+        from scipy.interpolate import interp1d
         gx_func = interp1d(x=dt*np.arange(len(pulse_shape)), y=grads_shape[0,:], bounds_error=False, fill_value=0)
         gy_func = interp1d(x=dt*np.arange(len(pulse_shape)), y=grads_shape[1,:], bounds_error=False, fill_value=0)
         gz_func = interp1d(x=dt*np.arange(len(pulse_shape)), y=grads_shape[2,:], bounds_error=False, fill_value=0)
@@ -440,6 +470,7 @@ class NumSolverSpinGroup(SpinGroup):
     # TODO fix problem with using this in sequence simulation
     # TODO override apply_rf
     def apply_rf_store(self, pulse_shape, grads_shape, dt):
+        from scipy.integrate import solve_ivp
         m = np.squeeze(self.m)
 
         ####
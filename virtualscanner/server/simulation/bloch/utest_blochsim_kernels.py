@@ -0,0 +1,363 @@
+# Copyright of the Board of Trustees of Columbia University in the City of New York
+# Unit tests comparing the compiled and vectorized simulation paths against the SpinGroup methods
+
+import importlib.util
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+from pypulseq.Sequence.sequence import Sequence
+
+import virtualscanner.server.simulation.bloch.pulseq_blochsim_kernels as kernels
+import virtualscanner.server.simulation.bloch.phantom as pht
+import virtualscanner.server.simulation.bloch.pulseq_blochsim_methods as blcsim
+import virtualscanner.server.simulation.bloch.pulseq_seqinfo as seqinfo
+import virtualscanner.server.simulation.bloch.spingroup_ps as sg
+
+HAS_CUPY = importlib.util.find_spec('cupy') is not None
+
+
+def make_commands(grad_type):
+    # RF pulse, delay, readout, gradient, readout
+    dt = 10e-6
+    timing = np.concatenate(([0], np.arange(2e-5, 2e-5 + 40*dt, dt)))
+    grad = np.vstack([0.01*np.sin(1e4*timing), 0.005*np.cos(3e3*timing), 0.001*np.ones(len(timing))])
+    b1 = 1e-6*np.exp(1j*np.linspace(0, 1, 50))
+    rf_grad = np.tile([[1e-3], [2e-3], [3e-3]], 50)
+    commands = 'pdrgr'
+    params = [[b1, rf_grad, 1e-6], [1e-3], [dt, 20, 2e-5, grad, timing, grad_type, 0.3],
+              [np.array([1e-6, 2e-6, -1e-6]), 1e-3], [dt, 20, 2e-5, grad, timing, grad_type, -0.3]]
+    return commands, params, dt
+
+
+def make_seq_info(grad_type):
+    return seqinfo.make_seq_info(*make_commands(grad_type))
+
+
+def make_spin():
+    return sg.SpinGroup(loc=(0.01, -0.02, 0.005), pdt1t2=(0.8, 1.0, 0.1), df=20)
+
+
+class TestBlochsimKernels(unittest.TestCase):
+
+    def check_same_as_spingroup(self, grad_type):
+        seq_info = make_seq_info(grad_type)
+        ref = make_spin()
+        blcsim.apply_pulseq_commands(ref, seq_info, store_m=True) # SpinGroup methods
+        spin = make_spin()
+        kernels.apply_packed_commands(spin, seq_info)
+
+        np.testing.assert_allclose(spin.m, ref.m, atol=1e-12)
+        self.assertEqual(len(spin.signal), len(ref.signal))
+        for s, s_ref in zip(spin.signal, ref.signal):
+            np.testing.assert_allclose(s, s_ref, atol=1e-12)
+
+    def test_trapz_readout(self):
+        self.check_same_as_spingroup('trap')
+
+    def test_arbitrary_readout(self):
+        self.check_same_as_spingroup('grad')
+
+    @unittest.skipUnless(kernels.HAS_BLOCHCORE and kernels.HAS_NUMBA, 'needs both compiled kernels')
+    def test_cython_same_as_numba(self):
+        for grad_type in ('trap', 'grad'):
+            seq_info = make_seq_info(grad_type)
+            args = (0.8, 1.0, 0.1, np.array([0.01, -0.02, 0.005]), 20.0, 0.9 + 0.1j)
+            m, m_ref = np.array([0, 0, 1.0]), np.array([0, 0, 1.0])
+            signal, lens = kernels._blochcore.run_pulseq_commands(seq_info, m, *args)
+            signal_ref, lens_ref = kernels.run_pulseq_commands(seq_info, m_ref, *args)
+
+            np.testing.assert_allclose(m, m_ref, atol=1e-12)
+            np.testing.assert_array_equal(lens, lens_ref)
+            np.testing.assert_allclose(signal, signal_ref, atol=1e-12)
+
+    def test_seq_info_layout(self):
+        commands, params, _ = make_commands('trap')
+        seq_info = make_seq_info('trap')
+        np.testing.assert_array_equal(seq_info.cmd_codes, [seqinfo.CMD_CODES[c] for c in 'pdrgr'])
+        np.testing.assert_array_equal(seq_info.cmd_index, [0, 0, 0, 0, 1])
+        self.assertEqual(seq_info.commands, commands)
+        # Delay command holds its duration
+        self.assertEqual(seq_info.delay_t[seq_info.cmd_index[1]], 1e-3)
+        # RF command holds its pulse shape
+        np.testing.assert_array_equal(seq_info.rf_offs, [0, 50])
+        # Both readouts are stored back to back
+        np.testing.assert_array_equal(seq_info.adc_offs, [0, 41, 82])
+        np.testing.assert_array_equal(seq_info.readout_lengths(), [20, 20])
+        for c in range(len(commands)):
+            cstr, cpars = seq_info.get_command(c)
+            self.assertEqual(cstr, commands[c])
+            for p, p_ref in zip(cpars, params[c]):
+                np.testing.assert_array_equal(p, p_ref)
+
+
+class TestVectorizedReadout(unittest.TestCase):
+
+    def test_same_as_fpwg_steps(self):
+        dt = 10e-6
+        timing = np.concatenate(([0], np.arange(2e-5, 2e-5 + 40*dt, dt)))
+        grad = np.vstack([0.01*np.sin(1e4*timing), 0.005*np.cos(3e3*timing), 0.001*np.ones(len(timing))])
+        for spin_type, kwargs in ((sg.SpinGroup, {}), (sg.SpinGroupDiffusion, {'D': 1e-3, 'b': 500})):
+            for n in (20, 50):
+                # One fpwg() per dwell interval, sampling before each as readout_trapz() used to
+                ref = spin_type(loc=(0.01, -0.02, 0.005), pdt1t2=(0.8, 1.0, 0.1), df=20, **kwargs)
+                ref.fpwg(np.trapz(y=grad[:,0:2], x=timing[0:2]), 2e-5)
+                signal_ref = []
+                for q in range(1, len(timing)):
+                    if q <= n:
+                        signal_ref.append(ref.get_m_signal())
+                    ref.fpwg(np.trapz(y=grad[:,q:q+2], dx=dt), dt)
+                spin = spin_type(loc=(0.01, -0.02, 0.005), pdt1t2=(0.8, 1.0, 0.1), df=20, **kwargs)
+                spin.readout_trapz(dwell=dt, n=n, delay=2e-5, grad=grad, timing=timing, phase=0)
+
+                np.testing.assert_allclose(spin.signal[0], signal_ref, atol=1e-12)
+                np.testing.assert_allclose(spin.m, ref.m, atol=1e-12)
+
+
+class TestBatchSimulation(unittest.TestCase):
+
+    def check_same_as_spingroups(self, grad_type):
+        seq_info = make_seq_info(grad_type)
+        locs = np.array([[0.01, -0.02, 0.005], [0, 0.03, 0], [-0.05, 0, 0.01]]).T
+        PD, T1, T2, df = np.array([0.8, 1, 0.5]), np.array([1, 0, 2]), np.array([0.1, 0.05, 0]), np.array([20, 0, -5])
+        ref = 0
+        for v in range(3):
+            spin = sg.SpinGroup(loc=tuple(locs[:,v]), pdt1t2=(PD[v], T1[v], T2[v]), df=df[v])
+            blcsim.apply_pulseq_commands(spin, seq_info, store_m=True)
+            ref = ref + np.array(spin.signal)
+        M = np.zeros((3, 3))
+        M[2] = 1
+        signal = blcsim.apply_pulseq_commands_batch(M, locs, PD, T1, T2, df, seq_info)
+
+        np.testing.assert_allclose(np.array(signal), ref, atol=1e-12)
+
+    def test_trapz_readout(self):
+        self.check_same_as_spingroups('trap')
+
+    def test_arbitrary_readout(self):
+        self.check_same_as_spingroups('grad')
+
+    @unittest.skipUnless(kernels.HAS_BLOCHCORE, 'needs the _blochcore extension')
+    def test_cython_batch(self):
+        seq_info = make_seq_info('grad')
+        locs = np.array([[0.01, -0.02, 0.005], [0, 0.03, 0], [-0.05, 0, 0.01]]).T
+        PD, T1, T2, df = np.array([0.8, 1, 0.5]), np.array([1.0, 0, 2]), np.array([0.1, 0.05, 0]), np.array([20.0, 0, -5])
+        M = np.zeros((3, 3))
+        M[2] = 1
+        M_c = np.ascontiguousarray(M.T)
+        ref = blcsim.apply_pulseq_commands_batch(M, locs, PD, T1, T2, df, seq_info)
+        signal, lens = kernels._blochcore.run_pulseq_commands_batch(
+            seq_info, M_c, PD, T1, T2, np.ascontiguousarray(locs.T), df, num_threads=2)
+
+        np.testing.assert_allclose(M_c, M.T, atol=1e-12)
+        np.testing.assert_allclose(signal, np.concatenate(ref), atol=1e-12)
+
+    def test_single_precision(self):
+        seq_info = make_seq_info('trap')
+        locs = np.array([[0.01, -0.02, 0.005], [0, 0.03, 0]]).T
+        PD, T1, T2, df = np.array([0.8, 1]), np.array([1, 0.5]), np.array([0.1, 0.05]), np.array([20, -5])
+        signals = []
+        for dtype in (np.float64, np.float32):
+            M = np.zeros((3, 2), dtype=dtype)
+            M[2] = 1
+            signal = blcsim.apply_pulseq_commands_batch(M, *(np.asarray(a, dtype=dtype) for a in (locs, PD, T1, T2, df)),
+                                                        seq_info)
+            self.assertEqual(M.dtype, dtype)
+            signals.append(np.array(signal))
+
+        np.testing.assert_allclose(signals[1], signals[0], rtol=1e-5, atol=1e-6*np.max(np.abs(signals[0])))
+
+
+class TestPhantomSimulation(unittest.TestCase):
+
+    def setUp(self):
+        self.phantom = pht.makeCylindricalPhantom(dim=2, n=4)
+        self.seq_info = make_seq_info('trap')
+        self.df_map = np.reshape(np.linspace(-30, 30, np.prod(self.phantom.get_shape())), self.phantom.get_shape())
+
+    def summed_spingroups(self, df_map):
+        df_map = np.broadcast_to(df_map, self.phantom.get_shape())
+        return sum(np.array(blcsim.sim_single_spingroup(loc_ind, df_map[loc_ind], self.phantom, self.seq_info))
+                   for loc_ind in self.phantom.get_list_inds())
+
+    @unittest.skipUnless(blcsim.HAS_SHARED_MEMORY, 'needs multiprocessing.shared_memory (Python 3.8+)')
+    def test_pool_uniform_df(self):
+        signal = blcsim.simulate_phantom(self.phantom, self.seq_info, freq_offset_map=20, n_proc=2)
+        np.testing.assert_allclose(signal, self.summed_spingroups(20), atol=1e-12)
+
+    @unittest.skipUnless(blcsim.HAS_SHARED_MEMORY, 'needs multiprocessing.shared_memory (Python 3.8+)')
+    def test_pool_df_map(self):
+        signal = blcsim.simulate_phantom(self.phantom, self.seq_info, freq_offset_map=self.df_map, n_proc=2)
+        np.testing.assert_allclose(signal, self.summed_spingroups(self.df_map), atol=1e-12)
+
+    def test_pool_without_shared_memory(self):
+        has_shared_memory = blcsim.HAS_SHARED_MEMORY
+        blcsim.HAS_SHARED_MEMORY = False
+        try:
+            signal = blcsim.simulate_phantom(self.phantom, self.seq_info, freq_offset_map=self.df_map, n_proc=2)
+        finally:
+            blcsim.HAS_SHARED_MEMORY = has_shared_memory
+        np.testing.assert_allclose(signal, self.summed_spingroups(self.df_map), atol=1e-12)
+
+    def test_batch_df_map(self):
+        signal = blcsim.simulate_phantom_batch(self.phantom, self.seq_info, freq_offset_map=self.df_map, backend='numpy')
+        np.testing.assert_allclose(signal, self.summed_spingroups(self.df_map), atol=1e-12)
+
+    @unittest.skipUnless(HAS_CUPY, 'needs cupy')
+    def test_batch_cuda(self):
+        ref = blcsim.simulate_phantom_batch(self.phantom, self.seq_info, freq_offset_map=self.df_map, backend='numpy')
+        signal = blcsim.simulate_phantom_batch(self.phantom, self.seq_info, freq_offset_map=self.df_map, backend='cuda')
+        np.testing.assert_allclose(signal, ref, atol=1e-10)
+
+    def test_batch_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            blcsim.simulate_phantom_batch(self.phantom, self.seq_info, backend='cpu')
+
+
+class TestMergePrecession(unittest.TestCase):
+
+    def test_merged_same_as_blocks(self):
+        commands, params, dt = make_commands('trap')
+        commands = 'dg' + commands[:3] + 'gdg' + commands[3:]
+        params = [[2e-3], [np.array([1e-6, 0, 2e-6]), 1e-3]] + params[:3] + \
+                 [[np.array([0, 3e-6, 0]), 2e-3], [1e-3], [np.array([-1e-6, 0, 0]), 5e-4]] + params[3:]
+        merged = seqinfo.make_seq_info(commands, params, dt, merge_precession=True)
+
+        self.assertEqual(merged.commands, 'gpdrgr')
+        np.testing.assert_allclose(merged.get_command(0)[1][0], [1e-6, 0, 2e-6])
+        self.assertAlmostEqual(merged.get_command(0)[1][1], 3e-3)
+        np.testing.assert_allclose(merged.get_command(4)[1][0], [0, 5e-6, -1e-6])
+        self.assertAlmostEqual(merged.get_command(4)[1][1], 4.5e-3)
+
+        ref = make_spin()
+        blcsim.apply_pulseq_commands(ref, seqinfo.make_seq_info(commands, params, dt), store_m=True)
+        spin = make_spin()
+        blcsim.apply_pulseq_commands(spin, merged, store_m=True)
+        np.testing.assert_allclose(spin.m, ref.m, atol=1e-12)
+        np.testing.assert_allclose(np.array(spin.signal), np.array(ref.signal), atol=1e-12)
+
+
+class TestRepeatedBlocks(unittest.TestCase):
+
+    def test_repeats_share_pool_entries(self):
+        commands, params, dt = make_commands('trap')
+        ref = seqinfo.make_seq_info(commands*3, params*3, dt)
+        builder = seqinfo.SeqInfoBuilder(grad_raster_time=dt, merge_precession=False)
+        add = {'d': builder.add_delay, 'p': builder.add_rf, 'r': builder.add_readout, 'g': builder.add_grad}
+        for rep in range(3):
+            for c, (cstr, cpars) in enumerate(zip(commands, params)):
+                if not builder.repeat(c):
+                    add[cstr](*cpars, key=c)
+        seq_info = builder.build()
+
+        self.assertEqual(seq_info.commands, ref.commands)
+        self.assertEqual(len(seq_info.rf_dt), 1)
+        self.assertEqual(len(seq_info.adc_n), 2)
+        np.testing.assert_array_equal(seq_info.readout_lengths(), ref.readout_lengths())
+        for run in (lambda spin, info: blcsim.apply_pulseq_commands(spin, info, store_m=True),
+                    kernels.apply_packed_commands):
+            spin, spin_ref = make_spin(), make_spin()
+            run(spin, seq_info)
+            run(spin_ref, ref)
+            np.testing.assert_allclose(spin.m, spin_ref.m, atol=1e-12)
+            np.testing.assert_allclose(np.array(spin.signal), np.array(spin_ref.signal), atol=1e-12)
+
+    def test_stored_sequence(self):
+        seq = Sequence()
+        seq.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim', 'seq_validation_files', 'tse32.seq'))
+        seq_info = blcsim.store_pulseq_commands(seq)
+        self.assertLess(len(seq_info.rf_dt), np.count_nonzero(seq_info.cmd_codes == seqinfo.CMD_RF))
+        self.assertLess(len(seq_info.adc_n), len(seq_info.readout_lengths()))
+
+
+class TestGradientAreas(unittest.TestCase):
+
+    def check_area(self, t):
+        waveform = np.sin(np.linspace(0, 3, len(t)))*1e5
+        blk = SimpleNamespace(gy=SimpleNamespace(type='grad', t=t, waveform=waveform))
+        areas = blcsim.combine_gradient_areas(blk)
+        np.testing.assert_allclose(areas, [0, np.trapz(y=waveform, x=t)/blcsim.GAMMA_BAR, 0], rtol=1e-12)
+
+    def test_uniform_raster(self):
+        self.check_area(np.arange(40)*1e-5)
+
+    def test_nonuniform_timing(self):
+        self.check_area(np.array([0, 1, 1.5, 4])*1e-5)
+
+
+class TestCombineGradients(unittest.TestCase):
+
+    def test_timing_count(self):
+        dt = 1e-5
+        for rise_time, delay, n in ((1e-4, 0, 25), (1e-4, 2e-5, 23), (1.05e-4, 0, 26)):
+            # 0.24 ms is not an exact multiple of 10 us in floating point; 0.245 ms ends between two points
+            blk = SimpleNamespace(gx=SimpleNamespace(type='trap', rise_time=rise_time, flat_time=4e-5,
+                                                     fall_time=1e-4, amplitude=1e5))
+            grad, timing, duration, grad_type = blcsim.combine_gradients(blk, dt=dt, delay=delay)
+
+            self.assertEqual(len(timing), n + 1)
+            self.assertEqual(timing[0], 0)
+            np.testing.assert_allclose(timing[1:], delay + dt*np.arange(n), rtol=0, atol=1e-15)
+            self.assertEqual(grad.shape, (3, n + 1))
+
+
+class TestSeqInfoCache(unittest.TestCase):
+
+    def setUp(self):
+        blcsim._SEQ_INFO_CACHE.clear()
+
+    def test_cached_same_as_stored(self):
+        seq_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim', 'seq_validation_files', 'tse32.seq')
+        seq = Sequence()
+        seq.read(seq_path)
+        ref = blcsim.store_pulseq_commands(seq)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            seq_info = blcsim.store_pulseq_commands_cached(seq_path, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertIs(blcsim.store_pulseq_commands_cached(seq_path, cache_dir=cache_dir), seq_info)
+            # Another cache directory gets its own file even though the sequence is already in memory
+            with tempfile.TemporaryDirectory() as other_dir:
+                blcsim.store_pulseq_commands_cached(seq_path, cache_dir=other_dir)
+                self.assertEqual(len(os.listdir(other_dir)), 1)
+            # A new process only finds the file on disk
+            blcsim._SEQ_INFO_CACHE.clear()
+            from_disk = blcsim.store_pulseq_commands_cached(seq_path, cache_dir=cache_dir)
+
+        for info in (seq_info, from_disk):
+            self.assertEqual(info.commands, ref.commands)
+            for a, a_ref in zip(info, ref):
+                np.testing.assert_array_equal(a, a_ref)
+
+    def test_memory_cache_bounded(self):
+        seq_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim', 'seq_validation_files', 'tse32.seq')
+        with open(seq_path, 'rb') as f:
+            contents = f.read()
+        old_size = blcsim.SEQ_INFO_CACHE_SIZE
+        blcsim.SEQ_INFO_CACHE_SIZE = 2
+        try:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                # Trailing comments change the file hash but not the sequence
+                paths = []
+                for n in range(3):
+                    paths.append(os.path.join(cache_dir, 'tse32_%d.seq' % n))
+                    with open(paths[-1], 'wb') as f:
+                        f.write(contents + b'# copy %d\n' % n)
+                first = blcsim.store_pulseq_commands_cached(paths[0], cache_dir=cache_dir)
+                second = blcsim.store_pulseq_commands_cached(paths[1], cache_dir=cache_dir)
+                # Using the first file again makes the second one the oldest entry
+                self.assertIs(blcsim.store_pulseq_commands_cached(paths[0], cache_dir=cache_dir), first)
+                blcsim.store_pulseq_commands_cached(paths[2], cache_dir=cache_dir)
+
+                self.assertEqual(len(blcsim._SEQ_INFO_CACHE), 2)
+                self.assertIs(blcsim.store_pulseq_commands_cached(paths[0], cache_dir=cache_dir), first)
+                self.assertIsNot(blcsim.store_pulseq_commands_cached(paths[1], cache_dir=cache_dir), second)
+        finally:
+            blcsim.SEQ_INFO_CACHE_SIZE = old_size
+            blcsim._SEQ_INFO_CACHE.clear()
+
+
+if __name__ == "__main__":
+    unittest.main()
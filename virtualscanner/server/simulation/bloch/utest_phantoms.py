@@ -1,5 +1,7 @@
+import pickle
 import unittest
 import virtualscanner.server.simulation.bloch.phantom as pht
+import virtualscanner.server.simulation.bloch.util as util
 import numpy as np
 from virtualscanner.utils import constants
 
@@ -44,6 +46,23 @@ class TestPhantoms(unittest.TestCase):
         np.testing.assert_allclose(phantom.T1map, maps[:,:,:,1])
         np.testing.assert_allclose(phantom.T2map, maps[:,:,:,2])
 
+    @unittest.skipUnless(util.HAS_SHARED_MEMORY, 'needs multiprocessing.shared_memory (Python 3.8+)')
+    def test_phantom_shared(self):
+        phantom = pht.makeCylindricalPhantom(n=32)
+        shared = pht.PhantomShared.from_phantom(phantom)
+        try:
+            # What a worker process receives: handles instead of the maps
+            data = pickle.dumps(shared)
+            self.assertLess(len(data), phantom.T1map.nbytes)
+            restored = pickle.loads(data)
+            for loc_ind in phantom.get_list_inds():
+                self.assertEqual(restored.get_location(loc_ind), phantom.get_location(loc_ind))
+                self.assertEqual(restored.get_params(loc_ind), phantom.get_params(loc_ind))
+            self.assertFalse(restored.PDmap.flags.owndata)
+            del restored
+        finally:
+            shared.close()
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+# Copyright of the Board of Trustees of Columbia University in the City of New York
+# Unit tests for the shared memory helpers in util
+
+import unittest
+
+import numpy as np
+
+import virtualscanner.server.simulation.bloch.pulseq_seqinfo as seqinfo
+from virtualscanner.server.simulation.bloch.util import SharedArray, share_arrays, attach_arrays
+
+try:
+    from multiprocessing import shared_memory
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    HAS_SHARED_MEMORY = False
+
+
+def make_seq_info():
+    b1 = 1e-6*np.exp(1j*np.linspace(0, 1, 10))
+    timing = np.arange(11)*1e-5
+    params = [[b1, np.ones((3, 10))*1e-3, 1e-6], [1e-3],
+              [1e-5, 10, 0, np.ones((3, 11))*1e-2, timing, 'trap', 0.3], [np.array([1e-6, 0, 0]), 1e-3]]
+    return seqinfo.make_seq_info('pdrg', params, 1e-5)
+
+
+@unittest.skipUnless(HAS_SHARED_MEMORY, 'needs multiprocessing.shared_memory (Python 3.8+)')
+class TestSharedArrays(unittest.TestCase):
+
+    def check_round_trip(self, obj, arrays):
+        shared_obj, shm = share_arrays(obj)
+        try:
+            attached, attached_shm = attach_arrays(shared_obj)
+            leaves = arrays(attached)
+            for a, a_ref in zip(leaves, arrays(obj)):
+                np.testing.assert_array_equal(a, a_ref)
+                self.assertEqual(a.dtype, a_ref.dtype)
+                # Views on the shared buffer rather than copies
+                self.assertFalse(a.flags.owndata)
+            leaves[0][...] = 7
+            again, again_shm = attach_arrays(shared_obj)
+            np.testing.assert_array_equal(arrays(again)[0], 7)
+            del leaves, attached, again
+            attached_shm.close()
+            again_shm.close()
+        finally:
+            shm.close()
+            shm.unlink()
+        # Unlinking removes the segment
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=shm.name)
+        return shared_obj
+
+    def test_seq_info(self):
+        seq_info = make_seq_info()
+        shared = self.check_round_trip(seq_info, lambda info: [a for a in info if isinstance(a, np.ndarray)])
+        self.assertIsInstance(shared, seqinfo.SeqInfo)
+        self.assertIsInstance(shared.rf_b1, SharedArray)
+        self.assertEqual(shared.grad_raster_time, seq_info.grad_raster_time)
+
+    def test_nested_dict(self):
+        obj = {'a': np.arange(5), 'b': [np.ones((2, 3)), (np.zeros(0), 'text')], 'c': 1.5}
+        shared = self.check_round_trip(obj, lambda o: [o['a'], o['b'][0], o['b'][1][0]])
+        self.assertEqual(shared['b'][1][1], 'text')
+        self.assertEqual(shared['c'], 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import namedtuple
 
 
 GAMMA_BAR = 42.5775e6
@@ -19,18 +20,18 @@ def find_precessing_time(blk,dt):
         Maximum gradient time, in seconds, among the three gradients Gx, Gy, and Gz
 
     """
-    grad_times = []
-    for g_name in ['gx','gy','gz']:
-        #if blk.__contains__(g_name):
-        if hasattr(blk, g_name):
-            #g = blk[g_name]
-            g = blk.__getattribute__(g_name)
+    max_time = None
+    for g in (getattr(blk, 'gx', None), getattr(blk, 'gy', None), getattr(blk, 'gz', None)):
+        if g is not None:
             tg = (g.rise_time + g.flat_time + g.fall_time) if g.type == 'trap' else len(np.squeeze(g.t))*dt
-            grad_times.append(tg)
-    return max(grad_times)
+            if max_time is None or tg > max_time:
+                max_time = tg
+    if max_time is None:
+        raise ValueError('Block has no gradients')
+    return max_time
 
 
-def combine_gradients(blk,dt=0,timing=(),delay=0):
+def combine_gradients(blk,dt=0,timing=(),delay=0,dtype=np.float64):
     """Helper function that merges multiple gradients into a format for simulation
 
     Interpolate x, y, and z gradients starting from time 0
@@ -50,6 +51,8 @@ def combine_gradients(blk,dt=0,timing=(),delay=0):
     delay : float, optional
             Adds an additional time interval in seconds at the beginning of the interpolation
             Default is 0; when nonzero it is only used in ADC sampling to realize ADC delay
+    dtype : numpy.dtype, optional
+        Floating point type of the returned gradient shape; default is numpy.float64
 
     Returns
     -------
@@ -67,32 +70,141 @@ def combine_gradients(blk,dt=0,timing=(),delay=0):
     Only input one argument between dt and timing and not the other
 
     """
-    grad_timing = []
+    grad_timing = np.zeros(0)
     duration = 0
     if dt != 0:
         duration = find_precessing_time(blk,dt)
-        grad_timing = np.concatenate(([0],np.arange(delay,duration+dt,dt)))
+        # Same points as [0] + np.arange(delay, duration+dt, dt), built in a single array; the count is
+        # rounded with a tolerance so that floating point error in (duration - delay)/dt, e.g. for
+        # durations like 0.24 ms, cannot add a point past the end of the block
+        n = max(int(np.ceil((duration - delay)/dt + 1 - 1e-6)), 0)
+        grad_timing = np.arange(-1, n, dtype=np.float64)
+        grad_timing *= dt
+        grad_timing += delay
+        grad_timing[0] = 0
     elif len(timing) != 0:
         duration = timing[-1] - timing[0]
-        grad_timing = timing
+        grad_timing = np.asarray(timing)
 
-    grad = []
-    g = None
+    grad = np.empty((3, len(grad_timing)), dtype=dtype)
+    grad_type = None
     # Interpolate gradient values at desired time points
-    for g_name in ['gx','gy','gz']:
-       # if blk.__contains__(g_name):
-        if hasattr(blk, g_name):
-            #g = blk[g_name]
-            g = blk.__getattribute__(g_name)
-            g_time, g_shape = ([0, g.rise_time, g.rise_time + g.flat_time, g.rise_time + g.flat_time + g.fall_time],
-                               [0,g.amplitude/GAMMA_BAR,g.amplitude/GAMMA_BAR,0]) if g.type == 'trap'\
-                               else (g.t, g.waveform/GAMMA_BAR)
-            g_time = np.array(g_time)
-            grad.append(np.interp(x=grad_timing,xp=g_time,fp=g_shape))
-        else:
-            grad.append(np.zeros(np.shape(grad_timing)))
-    if g is not None:
+    for i, g in enumerate((getattr(blk, 'gx', None), getattr(blk, 'gy', None), getattr(blk, 'gz', None))):
+        if g is None:
+            grad[i] = 0
+            continue
         grad_type = g.type
-    else:
-        grad_type = None
-    return np.array(grad), grad_timing, duration, grad_type
+        if grad_type == 'trap':
+            # Interpolate between the four corners of the trapezoid; np.interp on a tuple of corners
+            # is cheaper than building the waveform from clipped ramps for block-sized arrays
+            amp = g.amplitude/GAMMA_BAR
+            rise_time = g.rise_time
+            t_flat = rise_time + g.flat_time
+            grad[i] = np.interp(grad_timing, (0, rise_time, t_flat, t_flat + g.fall_time), (0, amp, amp, 0))
+        else:
+            grad[i] = np.interp(x=grad_timing,xp=g.t,fp=g.waveform/GAMMA_BAR)
+    return grad, grad_timing, duration, grad_type
+
+
+# Handle to a numpy array stored in a shared memory block
+SharedArray = namedtuple('SharedArray', ['shm_name', 'shape', 'dtype', 'offset'])
+
+
+def share_arrays(obj):
+    """Moves all numpy arrays nested in obj into a single shared memory block
+
+    Parameters
+    ----------
+    obj : dict, list, tuple, or numpy.ndarray
+        Structure holding numpy arrays, e.g. seq_info from store_pulseq_commands()
+
+    Returns
+    -------
+    shared_obj : dict, list, tuple, or SharedArray
+        Same structure with every array replaced by a lightweight SharedArray handle
+    shm : multiprocessing.shared_memory.SharedMemory
+        The shared memory block; the caller must close() and unlink() it when done
+
+    """
+    shared_memory = _shared_memory()
+    arrays = []
+    _map_nested(obj, lambda a: arrays.append(a) or a, np.ndarray)
+
+    # Lay arrays out one after another, aligned to 64 bytes
+    offsets = []
+    size = 0
+    for a in arrays:
+        offsets.append(size)
+        size += -(-a.nbytes//64)*64
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+    slots = iter(zip(arrays, offsets))
+
+    def to_shared(a):
+        a, offset = next(slots)
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset)[...] = a
+        return SharedArray(shm.name, a.shape, a.dtype.str, offset)
+
+    try:
+        return _map_nested(obj, to_shared, np.ndarray), shm
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+
+def attach_arrays(shared_obj):
+    """Rebuilds a structure made by share_arrays() with zero-copy views into shared memory
+
+    Parameters
+    ----------
+    shared_obj : dict, list, tuple, or SharedArray
+        Structure returned by share_arrays()
+
+    Returns
+    -------
+    obj : dict, list, tuple, or numpy.ndarray
+        Structure with numpy arrays backed by the shared memory block
+    shm : multiprocessing.shared_memory.SharedMemory or None
+        The attached block, which must be kept alive as long as the arrays are used
+
+    """
+    shared_memory = _shared_memory()
+    blocks = {}
+
+    def to_view(h):
+        if h.shm_name not in blocks:
+            blocks[h.shm_name] = shared_memory.SharedMemory(name=h.shm_name)
+        return np.ndarray(h.shape, np.dtype(h.dtype), buffer=blocks[h.shm_name].buf, offset=h.offset)
+
+    obj = _map_nested(shared_obj, to_view, SharedArray)
+    return obj, next(iter(blocks.values()), None)
+
+
+def _shared_memory():
+    """Imports multiprocessing.shared_memory, which needs Python 3.8 or later"""
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImportError('Sharing arrays between processes needs multiprocessing.shared_memory (Python 3.8+)')
+    return shared_memory
+
+
+try:
+    _shared_memory()
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    HAS_SHARED_MEMORY = False
+
+
+def _map_nested(obj, fn, leaf_type):
+    """Applies fn to every leaf_type object nested in dicts, lists, and tuples"""
+    if isinstance(obj, leaf_type):
+        return fn(obj)
+    if isinstance(obj, dict):
+        return {k: _map_nested(v, fn, leaf_type) for k, v in obj.items()}
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return type(obj)(*(_map_nested(v, fn, leaf_type) for v in obj))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_nested(v, fn, leaf_type) for v in obj)
+    return obj